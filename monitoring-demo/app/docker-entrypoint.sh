@@ -0,0 +1,11 @@
+#!/bin/sh
+set -e
+
+# prometheus_client requires the multiprocess directory to be wiped between
+# runs; stale *.db files would otherwise be reused or summed by new workers
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+fi
+
+exec "$@"
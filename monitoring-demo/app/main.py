@@ -1,21 +1,27 @@
 from fastapi import FastAPI, Request, HTTPException
+import os
+import asyncio
 import time
 import sys
-import json
+import atexit
+import orjson
+import queue
 import random
 import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from opentelemetry.trace import Status, StatusCode
-from opentelemetry import trace
+from opentelemetry import propagate, trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBasedTraceIdRatio
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 import prometheus_client
-from prometheus_client import Counter, Histogram
-from prometheus_fastapi_instrumentator import Instrumentator
-import uvicorn
-from typing import Dict, Any, Optional
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from pydantic import BaseModel
+from typing import Dict, Any, List, Optional
 
 # Setup logging
 logging.basicConfig(
@@ -31,8 +37,10 @@ resource = Resource.create({
     "environment": "development"
 })
 
-# Create tracer provider and set it
-tracer_provider = TracerProvider(resource=resource)
+# Create tracer provider and set it; only a fraction of traces are sampled
+# (metrics and logs still cover every request)
+sampler = ParentBasedTraceIdRatio(float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "0.1")))
+tracer_provider = TracerProvider(resource=resource, sampler=sampler)
 trace.set_tracer_provider(tracer_provider)
 tracer = trace.get_tracer(__name__)
 
@@ -42,30 +50,99 @@ otlp_exporter = OTLPSpanExporter(
     insecure=True  # Use TLS for production
 )
 
-# Add span processor to tracer provider
-span_processor = BatchSpanProcessor(otlp_exporter)
+# Add span processor to tracer provider; sized for bursty traffic and
+# overridable through the standard OTEL_BSP_* environment variables
+span_processor = BatchSpanProcessor(
+    otlp_exporter,
+    max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096")),
+    schedule_delay_millis=float(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000")),
+    max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256")),
+    export_timeout_millis=float(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000")),
+)
 tracer_provider.add_span_processor(span_processor)  # Fixed: use tracer_provider instance
 
 # Setup metrics
 REQUEST_COUNT = Counter('request_count', 'Total request count', ['method', 'endpoint', 'status'])
 REQUEST_LATENCY = Histogram('request_latency_seconds', 'Request latency', ['method', 'endpoint'])
 ERROR_COUNT = Counter('error_count', 'Total error count', ['method', 'endpoint', 'error_type'])
+# Summed over live workers when running under PROMETHEUS_MULTIPROC_DIR
+BSP_QUEUE_SIZE = Gauge('otel_bsp_queue_size', 'BatchSpanProcessor pending spans',
+                       multiprocess_mode='livesum')
+
+def bsp_queue(processor: BatchSpanProcessor):
+    """Return the pending-span deque of a BatchSpanProcessor across SDK versions"""
+    pending = getattr(processor, 'queue', None)
+    if pending is None:
+        pending = getattr(getattr(processor, '_batch_processor', None), '_queue', None)
+    return pending
+
+async def poll_bsp_queue(interval: float = 1.0) -> None:
+    """Publish the span queue depth; near max_queue_size means spans are dropped"""
+    # The deque lives as long as the processor, so resolve it only once
+    pending = bsp_queue(span_processor)
+    if pending is None:
+        logger.warning("BatchSpanProcessor queue not found; otel_bsp_queue_size disabled")
+        return
+    while True:
+        BSP_QUEUE_SIZE.set(len(pending))
+        await asyncio.sleep(interval)
+
+# Cache the bound child metrics so the hot path skips the labels() lookup
+@lru_cache(maxsize=1024)
+def _request_count(method: str, endpoint: str, status: int):
+    return REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status)
+
+@lru_cache(maxsize=1024)
+def _request_latency(method: str, endpoint: str):
+    return REQUEST_LATENCY.labels(method=method, endpoint=endpoint)
+
+@lru_cache(maxsize=1024)
+def _span_name(method: str, path: str) -> str:
+    return f"{method} {path}"
 
-app = FastAPI(title="Monitoring Demo API")
+@lru_cache(maxsize=1024)
+def _error_count(method: str, endpoint: str, error_type: str):
+    return ERROR_COUNT.labels(method=method, endpoint=endpoint, error_type=error_type)
 
-# Instrument the app with OpenTelemetry
-FastAPIInstrumentor.instrument_app(app, tracer_provider=tracer_provider)
+# Endpoints report errors with fixed labels, so bind those children up front
+SIMULATED_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/", error_type="simulated_error")
+HEALTH_CHECK_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/health", error_type="health_check_failed")
+DATA_FETCH_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/api/data", error_type="data_fetch_error")
+VALUE_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/api/error-test", error_type="value_error")
+KEY_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/api/error-test", error_type="key_error")
+DIVISION_ERROR_COUNT = ERROR_COUNT.labels(method="GET", endpoint="/api/error-test", error_type="division_error")
 
-# Instrument the app with Prometheus
-Instrumentator().instrument(app).expose(app)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Gauge callbacks are not collected in multiprocess mode, so each worker
+    # pushes its queue depth from a background task instead
+    poller = asyncio.create_task(poll_bsp_queue())
+    yield
+    poller.cancel()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
 
-def write_to_log_file(message: str) -> None:
-    """Write logs to a file for Promtail to scrape"""
-    try:
-        with open('/var/log/app/app.log', 'a') as f:
-            f.write(message + '\n')
-    except Exception as e:
-        print(f"Failed to write to log file: {e}")
+app = FastAPI(title="Monitoring Demo API", lifespan=lifespan)
+
+# Tracing and request metrics come from the monitor_requests middleware;
+# only the Prometheus exposition endpoint is needed on top of it
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+else:
+    metrics_registry = prometheus_client.REGISTRY
+app.mount("/metrics", prometheus_client.make_asgi_app(registry=metrics_registry))
+
+LOG_FILE = '/var/log/app/app.log'
+
+# Built-in LogRecord attributes; anything else on a record came from `extra`
+STANDARD_ATTRS = frozenset({
+    'args', 'asctime', 'created', 'exc_info', 'exc_text',
+    'filename', 'funcName', 'levelname', 'levelno', 'lineno',
+    'module', 'msecs', 'message', 'msg', 'name', 'pathname',
+    'process', 'processName', 'relativeCreated', 'stack_info',
+    'thread', 'threadName', 'taskName',
+})
 
 class LokiFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
@@ -80,93 +157,107 @@ class LokiFormatter(logging.Formatter):
         }
         
         # Handle extra attributes safely
-        extra_data = {}
-        for key, value in record.__dict__.items():
-            if key not in ['args', 'asctime', 'created', 'exc_info', 'exc_text', 
-                          'filename', 'funcName', 'levelname', 'levelno', 'lineno',
-                          'module', 'msecs', 'message', 'msg', 'name', 'pathname',
-                          'process', 'processName', 'relativeCreated', 'stack_info',
-                          'thread', 'threadName']:
-                extra_data[key] = value
+        log_data.update({
+            key: value for key, value in record.__dict__.items()
+            if key not in STANDARD_ATTRS
+        })
         
-        if extra_data:
-            log_data.update(extra_data)
+        # Trace context is passed as raw ints; hex-encode only when emitted
+        if isinstance(log_data.get('trace_id'), int):
+            log_data['trace_id'] = format(log_data['trace_id'], '032x')
+        if isinstance(log_data.get('span_id'), int):
+            log_data['span_id'] = format(log_data['span_id'], '016x')
             
-        json_log = json.dumps(log_data)
-        write_to_log_file(json_log)
+        # Handlers write text streams, so decode orjson's bytes output
+        json_log = orjson.dumps(log_data).decode()
         return json_log
 
-# Create console handler with Loki formatter
+# Create console and file (for Promtail to scrape) handlers; each sink does
+# exactly one write per record and both share a single formatter
+loki_formatter = LokiFormatter()
 handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(LokiFormatter())
-logger.addHandler(handler)
+handler.setFormatter(loki_formatter)
+log_handlers = [handler]
+
+# Open the file up front: an unwritable path must not fail the import, and a
+# failed lazy open inside FileHandler.emit would kill the listener thread
+try:
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    file_handler = logging.FileHandler(LOG_FILE)
+except OSError as e:
+    print(f"Failed to open log file, logging to stdout only: {e}")
+else:
+    file_handler.setFormatter(loki_formatter)
+    log_handlers.append(file_handler)
 
-# Remove any existing handlers to avoid duplicate logs
-logger.handlers = [handler]
+# Format and write records on a background thread so request handlers
+# only pay for an in-memory enqueue
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
 
-def log_with_extra(message: str, extra_data: Optional[Dict[str, Any]] = None) -> None:
-    """Helper function to log with extra data safely"""
-    if extra_data:
-        # Create a copy to avoid modifying the original dict
-        log_extra = extra_data.copy()
-        logger.info(message, extra=log_extra)
-    else:
-        logger.info(message)
+# Remove any existing handlers to avoid duplicate logs, and stop records from
+# also reaching the root (basicConfig) handler on the request thread
+logger.handlers = [queue_handler]
+logger.propagate = False
 
 @app.middleware("http")
 async def monitor_requests(request: Request, call_next):
-    start_time = time.time()
+    start_time = time.perf_counter()
+    method = request.method
+    path = request.url.path
     
-    with tracer.start_as_current_span(f"{request.method} {request.url.path}") as span:
-        span.set_attribute("http.method", request.method)
-        span.set_attribute("http.url", str(request.url))
-        if request.client:
-            span.set_attribute("http.client_ip", request.client.host)
+    # Continue the caller's trace (W3C traceparent) as this service's server span
+    with tracer.start_as_current_span(
+        _span_name(method, path),
+        context=propagate.extract(request.headers),
+        kind=trace.SpanKind.SERVER,
+    ) as span:
+        # Most spans are sampled out; skip building attributes nobody records
+        recording = span.is_recording()
+        if recording:
+            span.set_attribute("http.method", method)
+            span.set_attribute("http.url", str(request.url))
+            if request.client:
+                span.set_attribute("http.client_ip", request.client.host)
         
         try:
             response = await call_next(request)
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            status_code = response.status_code
             
             # Record metrics
-            REQUEST_COUNT.labels(
-                method=request.method,
-                endpoint=request.url.path,
-                status=response.status_code
-            ).inc()
-            
-            REQUEST_LATENCY.labels(
-                method=request.method,
-                endpoint=request.url.path
-            ).observe(processing_time)
+            _request_count(method, path, status_code).inc()
+            _request_latency(method, path).observe(processing_time)
             
             # Set span attributes
-            span.set_attribute("http.status_code", response.status_code)
-            span.set_attribute("http.response_time", processing_time)
-            
-            # Log the request safely
-            log_extra = {
-                'method': request.method,
-                'endpoint': request.url.path,
-                'status_code': response.status_code,
-                'latency_seconds': round(processing_time, 3),
-                'user_agent': request.headers.get('user-agent', ''),
-                'trace_id': format(span.get_span_context().trace_id, '032x'),
-                'span_id': format(span.get_span_context().span_id, '016x')
-            }
-            if request.client:
-                log_extra['ip'] = request.client.host
+            if recording:
+                span.set_attribute("http.status_code", status_code)
+                span.set_attribute("http.response_time", processing_time)
             
-            log_with_extra("Request processed", log_extra)
+            # Log the request; skip building the record when INFO is disabled
+            if logger.isEnabledFor(logging.INFO):
+                span_context = span.get_span_context()
+                log_extra = {
+                    'method': method,
+                    'endpoint': path,
+                    'status_code': status_code,
+                    'latency_seconds': processing_time,
+                    'user_agent': request.headers.get('user-agent', ''),
+                    'trace_id': span_context.trace_id,
+                    'span_id': span_context.span_id
+                }
+                if request.client:
+                    log_extra['ip'] = request.client.host
+                
+                logger.info("Request processed", extra=log_extra)
             
             return response
             
         except HTTPException as he:
-            processing_time = time.time() - start_time
-            ERROR_COUNT.labels(
-                method=request.method,
-                endpoint=request.url.path,
-                error_type="http_error"
-            ).inc()
+            _error_count(method, path, "http_error").inc()
             
             span.set_attribute("http.status_code", he.status_code)
             span.record_exception(he)
@@ -176,12 +267,7 @@ async def monitor_requests(request: Request, call_next):
             raise
             
         except Exception as e:
-            processing_time = time.time() - start_time
-            ERROR_COUNT.labels(
-                method=request.method,
-                endpoint=request.url.path,
-                error_type="server_error"
-            ).inc()
+            _error_count(method, path, "server_error").inc()
             
             span.record_exception(e)
             span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
@@ -195,15 +281,11 @@ async def root():
     with tracer.start_as_current_span("root_endpoint") as span:
         # Simulate some processing time
         processing_time = random.uniform(0.1, 0.5)
-        time.sleep(processing_time)
+        await asyncio.sleep(processing_time)
         
         # Occasionally simulate errors (20% chance)
         if random.random() < 0.2:
-            ERROR_COUNT.labels(
-                method="GET",
-                endpoint="/",
-                error_type="simulated_error"
-            ).inc()
+            SIMULATED_ERROR_COUNT.inc()
             span.record_exception(ValueError("Simulated error"))
             span.set_status(trace.Status(trace.StatusCode.ERROR, "Simulated error"))
             raise HTTPException(status_code=500, detail="Simulated server error")
@@ -216,47 +298,50 @@ async def health():
     with tracer.start_as_current_span("health_check"):
         # Simulate occasional health check failures (10% chance)
         if random.random() < 0.1:
-            ERROR_COUNT.labels(
-                method="GET",
-                endpoint="/health",
-                error_type="health_check_failed"
-            ).inc()
+            HEALTH_CHECK_ERROR_COUNT.inc()
             raise HTTPException(status_code=503, detail="Service temporarily unavailable")
         
         return {"status": "healthy", "timestamp": time.time()}
 
+class Item(BaseModel):
+    id: int
+    name: str
+
+class DataResponse(BaseModel):
+    items: List[Item]
+    processing_time: float
+    timestamp: float
+
+# Static payload for /api/data, built once rather than per request
+ITEMS = [
+    Item(id=1, name="Item 1"),
+    Item(id=2, name="Item 2"),
+    Item(id=3, name="Item 3")
+]
+
+# The declared return type lets FastAPI serialize through Pydantic directly
 @app.get("/api/data")
-async def get_data():
+async def get_data() -> DataResponse:
     with tracer.start_as_current_span("get_data_endpoint") as span:
         # Simulate data processing
         processing_time = random.uniform(0.2, 1.0)
-        time.sleep(processing_time)
+        await asyncio.sleep(processing_time)
         
         # Simulate occasional data fetch errors (15% chance)
         if random.random() < 0.15:
-            ERROR_COUNT.labels(
-                method="GET",
-                endpoint="/api/data",
-                error_type="data_fetch_error"
-            ).inc()
+            DATA_FETCH_ERROR_COUNT.inc()
             span.record_exception(ValueError("Data fetch error"))
             span.set_status(trace.Status(trace.StatusCode.ERROR, "Data not available"))
             raise HTTPException(status_code=404, detail="Data not available")
         
-        data = {
-            "items": [
-                {"id": 1, "name": "Item 1"},
-                {"id": 2, "name": "Item 2"},
-                {"id": 3, "name": "Item 3"}
-            ],
-            "processing_time": processing_time,
-            "timestamp": time.time()
-        }
-        
-        span.set_attribute("data.items_count", len(data["items"]))
+        span.set_attribute("data.items_count", len(ITEMS))
         span.set_attribute("processing_time", processing_time)
         
-        return data
+        return DataResponse(
+            items=ITEMS,
+            processing_time=processing_time,
+            timestamp=time.time()
+        )
     
 @app.get("/api/error-test")
 async def error_test(type: Optional[str] = None):
@@ -267,27 +352,24 @@ async def error_test(type: Optional[str] = None):
         )
 
         if error_type == "value_error":
-            ERROR_COUNT.labels("GET", "/api/error-test", "value_error").inc()
+            VALUE_ERROR_COUNT.inc()
             exc = ValueError("This is a simulated value error")
             span.record_exception(exc)
             span.set_status(Status(StatusCode.ERROR, "Value error"))
             raise HTTPException(status_code=500, detail=str(exc))
 
         elif error_type == "key_error":
-            ERROR_COUNT.labels("GET", "/api/error-test", "key_error").inc()
+            KEY_ERROR_COUNT.inc()
             exc = KeyError("This is a simulated key error")
             span.record_exception(exc)
             span.set_status(Status(StatusCode.ERROR, "Key error"))
             raise HTTPException(status_code=500, detail=str(exc))
 
         else:  # division_error
-            ERROR_COUNT.labels("GET", "/api/error-test", "division_error").inc()
+            DIVISION_ERROR_COUNT.inc()
             try:
                 _ = 1 / 0
             except ZeroDivisionError as exc:
                 span.record_exception(exc)
                 span.set_status(Status(StatusCode.ERROR, "Division error"))
                 raise HTTPException(status_code=500, detail=str(exc))
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import glob
+import os
+
+import uvicorn
+
+# Launch main:app from a separate module so each worker imports main.py (and
+# registers its metrics) exactly once; main.py must not import this file.
+if __name__ == "__main__":
+    # Workers are separate processes, so metrics must be aggregated through
+    # a shared multiprocess directory. It is set here, before any process
+    # imports prometheus_client, and inherited by the spawned workers.
+    # Clear metric files left by earlier runs.
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-multiproc")
+    os.makedirs(metrics_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(stale)
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+    )
@@ -1,7 +1,7 @@
-import requests
+import aiohttp
+import asyncio
 import time
 import random
-import threading
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -9,41 +9,52 @@ logger = logging.getLogger(__name__)
 
 BASE_URL = "http://localhost:8000"
 ENDPOINTS = ["/", "/api/data", "/health"]
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
 
-def make_request():
+# Draw endpoints and delays once up front; workers cycle through them
+SAMPLE_SIZE = 100_000
+ENDPOINT_SAMPLES = random.choices(ENDPOINTS, k=SAMPLE_SIZE)
+DELAY_SAMPLES = [random.uniform(0.1, 1.0) for _ in range(SAMPLE_SIZE)]
+
+async def make_request(session):
+    # Start each worker at its own offset so they don't move in lockstep
+    index = random.randrange(SAMPLE_SIZE)
     while True:
-        endpoint = random.choice(ENDPOINTS)
+        endpoint = ENDPOINT_SAMPLES[index]
+        delay = DELAY_SAMPLES[index]
+        index = (index + 1) % SAMPLE_SIZE
         url = f"{BASE_URL}{endpoint}"
-        
+
         try:
             start_time = time.time()
-            response = requests.get(url, timeout=10)
+            async with session.get(url, timeout=REQUEST_TIMEOUT) as response:
+                await response.read()
             latency = time.time() - start_time
-            
-            logger.info(f"Request to {endpoint} - Status: {response.status_code} - Latency: {latency:.3f}s")
-            
+
+            logger.info(f"Request to {endpoint} - Status: {response.status} - Latency: {latency:.3f}s")
+
         except Exception as e:
             logger.error(f"Request to {endpoint} failed: {str(e)}")
-        
+
         # Random delay between requests
-        time.sleep(random.uniform(0.1, 1.0))
-
-def simulate_traffic(num_threads=5):
-    threads = []
-    
-    for i in range(num_threads):
-        thread = threading.Thread(target=make_request, daemon=True)
-        threads.append(thread)
-        thread.start()
-        logger.info(f"Started traffic thread {i+1}")
-    
-    # Keep main thread alive
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Stopping traffic simulation")
+        await asyncio.sleep(delay)
+
+async def simulate_traffic(num_workers=50):
+    # One session shares a keep-alive connection pool across all workers,
+    # bounded to one connection per worker
+    connector = aiohttp.TCPConnector(limit=num_workers, keepalive_timeout=30)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workers = []
+
+        for i in range(num_workers):
+            workers.append(asyncio.create_task(make_request(session)))
+            logger.info(f"Started traffic worker {i+1}")
+
+        await asyncio.gather(*workers)
 
 if __name__ == "__main__":
     print("Starting traffic simulation...")
-    simulate_traffic(num_threads=5)
\ No newline at end of file
+    try:
+        asyncio.run(simulate_traffic(num_workers=50))
+    except KeyboardInterrupt:
+        logger.info("Stopping traffic simulation")